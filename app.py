@@ -1,5 +1,10 @@
 import os
 import re
+import io
+import struct
+import json
+import hashlib
+import mimetypes
 import traceback
 import requests
 import markdown
@@ -404,10 +409,155 @@ HTML_TEMPLATE = Template('''<!DOCTYPE html>
 </body>
 </html>''')
 
+# MP4 (ISO BMFF) 処理
+MP4_CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts', b'dinf'}
+MP4_MAX_MOOV_SIZE = 64 * 1024 * 1024
+MP4_COPY_CHUNK_SIZE = 64 * 1024
+
+
+def iter_mp4_boxes(f, start: int, end: int):
+    """[start, end) の範囲にある box を (type, offset, size, header_size) で列挙する."""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise ValueError(f"broken box {box_type!r} at {offset}")
+        yield box_type, offset, size, header_size
+        offset += size
+
+
+def iter_mp4_children(data: bytes, start: int, end: int):
+    """メモリ上の box データから子 box を (type, offset, size, header_size) で列挙する."""
+    f = io.BytesIO(data)
+    for box in iter_mp4_boxes(f, start, end):
+        yield box
+        if box[0] in MP4_CONTAINER_BOXES:
+            yield from iter_mp4_children(data, box[1] + box[3], box[1] + box[2])
+
+
+def copy_range(src, dst, offset: int, length: int):
+    """src の offset から length バイトを dst へチャンク単位でコピーする."""
+    src.seek(offset)
+    while length > 0:
+        chunk = src.read(min(MP4_COPY_CHUNK_SIZE, length))
+        if not chunk:
+            raise ValueError("unexpected end of file")
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def faststart_mp4(path: str) -> bool:
+    """
+    moov atom を最初の mdat の前へ移動し、stco/co64 のチャンクオフセットを補正する。
+    mdat はストリーミングでコピーするので、メモリに載るのは moov のみ。
+    書き換えた場合は True を返す。
+    """
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        boxes = list(iter_mp4_boxes(f, 0, file_size))
+        moov = next((b for b in boxes if b[0] == b'moov'), None)
+        mdat = next((b for b in boxes if b[0] == b'mdat'), None)
+        if moov is None or mdat is None or moov[1] < mdat[1]:
+            return False
+        _, moov_offset, moov_size, _ = moov
+        if moov_size > MP4_MAX_MOOV_SIZE:
+            raise ValueError(f"moov too large: {moov_size} bytes")
+
+        f.seek(moov_offset)
+        moov_data = bytearray(f.read(moov_size))
+        insert_at = mdat[1]
+        moov_end = moov_offset + moov_size
+
+        # moov の挿入位置以降、元の moov より前にあるデータは moov_size だけ後ろへずれる
+        for box_type, offset, size, header_size in iter_mp4_children(bytes(moov_data), 0, moov_size):
+            if box_type not in (b'stco', b'co64'):
+                continue
+            entry_fmt, entry_size = ('>I', 4) if box_type == b'stco' else ('>Q', 8)
+            body = offset + header_size
+            count = struct.unpack_from('>I', moov_data, body + 4)[0]
+            pos = body + 8
+            for _ in range(count):
+                chunk_offset = struct.unpack_from(entry_fmt, moov_data, pos)[0]
+                if insert_at <= chunk_offset < moov_end:
+                    chunk_offset += moov_size
+                    if box_type == b'stco' and chunk_offset > 0xFFFFFFFF:
+                        raise ValueError("stco offset overflow")
+                    struct.pack_into(entry_fmt, moov_data, pos, chunk_offset)
+                pos += entry_size
+
+        tmp_path = path + '.faststart'
+        try:
+            with open(tmp_path, 'wb') as out:
+                copy_range(f, out, 0, insert_at)
+                out.write(moov_data)
+                copy_range(f, out, insert_at, moov_offset - insert_at)
+                copy_range(f, out, moov_end, file_size - moov_end)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+    return True
+
+
+def read_mp4_info(path: str) -> dict:
+    """mvhd/tkhd から再生時間(秒)と映像トラックの幅/高さを取得する."""
+    info = {'width': 0, 'height': 0, 'duration': 0.0}
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        moov = next((b for b in iter_mp4_boxes(f, 0, file_size) if b[0] == b'moov'), None)
+        if moov is None:
+            return info
+        _, moov_offset, moov_size, _ = moov
+        if moov_size > MP4_MAX_MOOV_SIZE:
+            raise ValueError(f"moov too large: {moov_size} bytes")
+        f.seek(moov_offset)
+        moov_data = f.read(moov_size)
+
+    for box_type, offset, size, header_size in iter_mp4_children(moov_data, 0, moov_size):
+        body = offset + header_size
+        version = moov_data[body]
+        if box_type == b'mvhd':
+            if version == 1:
+                timescale, duration = struct.unpack_from('>IQ', moov_data, body + 20)
+            else:
+                timescale, duration = struct.unpack_from('>II', moov_data, body + 12)
+            if timescale:
+                info['duration'] = duration / timescale
+        elif box_type == b'tkhd' and not info['width']:
+            # width/height は 16.16 固定小数点。音声トラックは 0
+            dims_at = body + (88 if version == 1 else 76)
+            width, height = struct.unpack_from('>II', moov_data, dims_at)
+            info['width'], info['height'] = width >> 16, height >> 16
+    return info
+
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+def load_manifest_hashes(data: bytes) -> dict:
+    """クライアントが送ってきた manifest.json を {path: sha256} に変換する."""
+    manifest = json.loads(data.decode('utf-8'))
+    return {entry['path']: entry['sha256'] for entry in manifest['files']}
+
+
 class ContentConverter:
     def __init__(self):
         self.today = datetime.today()
         self.base_url = "https://mizuame.works/blog"
+        # 動画メタデータのキャッシュ (sha256 -> {'width', 'height', 'duration'})
+        self.video_cache = {}
+        # ダウンロード済み動画のメタデータ (保存先フルパス -> メタデータ)
+        self.video_info = {}
 
     def get_metadata(self, content: str):
         """Extract metadata (title and description) from content"""
@@ -445,17 +595,23 @@ class ContentConverter:
                     local_filename = f"{name}_{counter}{ext}"
                     counter += 1
 
+                local_path = os.path.join(file_dir, local_filename)
                 try:
                     response = requests.get(src, stream=True)
                     response.raise_for_status()
-                    with open(os.path.join(file_dir, local_filename), 'wb') as f:
+                    digest = hashlib.sha256()
+                    with open(local_path, 'wb') as f:
                         for chunk in response.iter_content(chunk_size=8192):
+                            digest.update(chunk)
                             f.write(chunk)
                     print(f"Downloaded: {src} -> {local_filename}")
                     new_src = local_filename
                 except Exception as e:
                     print(f"Failed to download {src}: {e}")
                     new_src = src
+                else:
+                    if os.path.splitext(local_filename)[1].lower() == '.mp4':
+                        self.process_video(local_path, digest.hexdigest())
             else:
                 # ローカルパス等はそのまま
                 new_src = src
@@ -466,6 +622,23 @@ class ContentConverter:
         content = re.sub(pattern, replace_media_link, content)
         return content
 
+    def process_video(self, path: str, content_hash: str):
+        """
+        ダウンロードした MP4 の後処理
+        - moov atom が mdat より後ろにあれば先頭側へ移動 (faststart)
+        - 幅/高さ/再生時間を取得し、コンテンツハッシュ単位でキャッシュ
+        """
+        try:
+            if faststart_mp4(path):
+                print(f"Faststart: {os.path.basename(path)}")
+            info = self.video_cache.get(content_hash)
+            if info is None:
+                info = read_mp4_info(path)
+                self.video_cache[content_hash] = info
+            self.video_info[path] = info
+        except Exception as e:
+            print(f"Failed to process video {path}: {e}")
+
     def slugify(self, text: str) -> str:
         """URL-friendly slug."""
         text = unicodedata.normalize('NFKC', text)
@@ -545,9 +718,16 @@ class ContentConverter:
             src = m.group(2)
             ext = os.path.splitext(src)[1].lower()
             if ext == '.mp4':
+                attrs = 'controls preload="metadata"'
+                info = self.video_info.pop(os.path.join(output_dir, src), None)
+                if info:
+                    if info['width'] and info['height']:
+                        attrs += f' width="{info["width"]}" height="{info["height"]}"'
+                    if info['duration']:
+                        attrs += f' data-duration="{info["duration"]:.3f}"'
                 return f'''
 <div class="video-container mb-4">
-    <video controls class="responsive-media">
+    <video {attrs} class="responsive-media">
         <source src="{src}" type="video/mp4">
         Your browser does not support the video tag.
     </video>
@@ -585,6 +765,25 @@ class ContentConverter:
         html = self.add_ids_to_headings(html)
         return html
 
+    def build_manifest(self, file_dir: str, files: list) -> dict:
+        """各ファイルのパス/サイズ/sha256/MIMEタイプを列挙したマニフェストを作る."""
+        entries = []
+        for name in sorted(files):
+            full_path = os.path.join(file_dir, name)
+            if not os.path.isfile(full_path):
+                continue
+            digest = hashlib.sha256()
+            with open(full_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(MP4_COPY_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            entries.append({
+                'path': name,
+                'size': os.path.getsize(full_path),
+                'sha256': digest.hexdigest(),
+                'mime_type': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            })
+        return {'files': entries}
+
     def convert_content(self, md_bytes: bytes) -> (str, str, list):
         """
         Markdown バイト列を受け取り、(index.html の中身, 使用した出力ディレクトリ, ダウンロードしたファイル名リスト)
@@ -620,6 +819,12 @@ class ContentConverter:
         # が存在する。
         # どんなファイルがあるか列挙して返す
         downloaded_files = os.listdir(tmp_dir)
+
+        # manifest.json (CDN への差分アップロード用)
+        manifest = self.build_manifest(tmp_dir, downloaded_files)
+        with open(os.path.join(tmp_dir, MANIFEST_FILENAME), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        downloaded_files.append(MANIFEST_FILENAME)
         return index_path, tmp_dir, downloaded_files
 
 
@@ -639,6 +844,7 @@ INDEX_HTML = """\
   <h1>Markdown Converter</h1>
   <form action="/upload" method="post" enctype="multipart/form-data">
     <label>Markdownファイルをアップロード: <input type="file" name="md_file"></label>
+    <label>前回の manifest.json (任意・変更ファイルのみ返す): <input type="file" name="manifest"></label>
     <button type="submit">変換</button>
   </form>
 </body>
@@ -656,7 +862,8 @@ def top_page():
 def upload_md():
     """
     アップロードされた Markdown を変換し、
-    変換結果一式(index.html + ダウンロードした画像等)を ZIP にまとめて返す。
+    変換結果一式(index.html + ダウンロードした画像等 + manifest.json)を ZIP にまとめて返す。
+    manifest に前回の manifest.json が渡された場合は、ハッシュが変わったファイルのみを含める。
     """
     if "md_file" not in request.files:
         return "ファイルが見つかりません", 400
@@ -665,10 +872,28 @@ def upload_md():
     if md_file.filename == "":
         return "ファイル名が空です", 400
 
+    previous_hashes = None
+    manifest_file = request.files.get("manifest")
+    if manifest_file and manifest_file.filename != "":
+        try:
+            previous_hashes = load_manifest_hashes(manifest_file.read())
+        except (ValueError, KeyError, TypeError) as e:
+            return f"manifest.json が不正です: {e}", 400
+
     try:
         md_data = md_file.read()
         index_path, tmp_dir, files = converter.convert_content(md_data)
 
+        # 差分のみ返す場合は、ハッシュが一致するファイルを除外
+        if previous_hashes is not None:
+            with open(os.path.join(tmp_dir, MANIFEST_FILENAME), encoding="utf-8") as mf:
+                manifest = json.load(mf)
+            unchanged = {
+                entry['path'] for entry in manifest['files']
+                if previous_hashes.get(entry['path']) == entry['sha256']
+            }
+            files = [f for f in files if f not in unchanged]
+
         # ZIP 作成
         zip_file_path = os.path.join(tmp_dir, "result.zip")
         with zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED) as zf: